@@ -4,6 +4,7 @@
 import sys
 import numpy as np
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 
 IS_PYTHON3 = sys.version_info[0] >= 3
 MAX_IMAGE_ID = 2**31 - 1
@@ -82,9 +83,29 @@ CREATE_ALL = "; ".join(
     ]
 )
 
+# Bulk-ingest tuning applied on connect: no fsync, WAL journal, in-memory temp
+# storage, a 64 MB page cache and an exclusive lock. COLMAP writes the same
+# database before (feature_extractor) and after (matcher, mapper) this script,
+# so close() restores the original journal mode instead of leaving the file
+# in WAL. A crash mid-injection can lose the injected priors, which are simply
+# re-injected by rerunning the script.
+INGEST_PRAGMAS = "; ".join(
+    [
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=OFF",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-64000",
+        "PRAGMA locking_mode=EXCLUSIVE",
+    ]
+)
+
 def array_to_blob(array):
+    # sqlite3 binds any buffer as a BLOB, so a byte view of the contiguous
+    # array avoids the copy tobytes() makes. Call bytes() on the result
+    # where a standalone bytes object is needed.
+    array = np.ascontiguousarray(array)
     if IS_PYTHON3:
-        return array.tobytes()
+        return memoryview(array).cast('B')
     else:
         return np.getbuffer(array)
 
@@ -106,30 +127,82 @@ _MODERN_PRIOR_Q_COLUMNS = (
 _MODERN_PRIOR_T_COLUMNS = ("tvec_prior_x", "tvec_prior_y", "tvec_prior_z")
 
 
+def _format_update_image_sql(prior_q_columns, prior_t_columns):
+    column_updates = [f"{col}=?" for col in prior_q_columns + prior_t_columns]
+    column_updates.append("camera_id=?")
+    return f"UPDATE images SET {', '.join(column_updates)} WHERE image_id=?"
+
+
+# Built once at import so every connection passes the same string to execute().
+_UPDATE_IMAGE_SQL = {
+    (_LEGACY_PRIOR_Q_COLUMNS, _LEGACY_PRIOR_T_COLUMNS):
+        _format_update_image_sql(_LEGACY_PRIOR_Q_COLUMNS, _LEGACY_PRIOR_T_COLUMNS),
+    (_MODERN_PRIOR_Q_COLUMNS, _MODERN_PRIOR_T_COLUMNS):
+        _format_update_image_sql(_MODERN_PRIOR_Q_COLUMNS, _MODERN_PRIOR_T_COLUMNS),
+}
+
+
 class COLMAPDatabase(sqlite3.Connection):
 
     @staticmethod
-    def connect(database_path):
-        return sqlite3.connect(database_path, factory=COLMAPDatabase)
+    def connect(database_path, durable=False):
+        # Transactions are opened explicitly with BEGIN around batched writes.
+        db = sqlite3.connect(database_path, factory=COLMAPDatabase,
+                             cached_statements=256, isolation_level=None)
+        # Keep SQLite's default journaling and fsync behaviour when durable.
+        if not durable:
+            db._journal_mode = db.execute("PRAGMA journal_mode").fetchone()[0]
+            try:
+                db.executescript(INGEST_PRAGMAS)
+            except BaseException:
+                db.close()
+                raise
+        return db
 
     def __init__(self, *args, **kwargs):
         super(COLMAPDatabase, self).__init__(*args, **kwargs)
 
-        self.create_tables = lambda: self.executescript(CREATE_ALL)
-        self.create_cameras_table = \
-            lambda: self.executescript(CREATE_CAMERAS_TABLE)
-        self.create_descriptors_table = \
-            lambda: self.executescript(CREATE_DESCRIPTORS_TABLE)
-        self.create_images_table = \
-            lambda: self.executescript(CREATE_IMAGES_TABLE)
-        self.create_two_view_geometries_table = \
-            lambda: self.executescript(CREATE_TWO_VIEW_GEOMETRIES_TABLE)
-        self.create_keypoints_table = \
-            lambda: self.executescript(CREATE_KEYPOINTS_TABLE)
-        self.create_matches_table = \
-            lambda: self.executescript(CREATE_MATCHES_TABLE)
-        self.create_name_index = lambda: self.executescript(CREATE_NAME_INDEX)
+        self._journal_mode = None
         self._image_prior_columns = None
+        self._update_image_sql = None
+
+    def close(self):
+        try:
+            if self._journal_mode is not None:
+                # Uncommitted work is discarded by close() anyway, and the
+                # journal mode cannot be changed inside a transaction.
+                if self.in_transaction:
+                    self.rollback()
+                journal_mode = self._journal_mode
+                self._journal_mode = None
+                self.execute(f"PRAGMA journal_mode={journal_mode}")
+        finally:
+            # Always release the exclusive lock, even if the restore fails.
+            super(COLMAPDatabase, self).close()
+
+    def create_tables(self):
+        return self.executescript(CREATE_ALL)
+
+    def create_cameras_table(self):
+        return self.executescript(CREATE_CAMERAS_TABLE)
+
+    def create_descriptors_table(self):
+        return self.executescript(CREATE_DESCRIPTORS_TABLE)
+
+    def create_images_table(self):
+        return self.executescript(CREATE_IMAGES_TABLE)
+
+    def create_two_view_geometries_table(self):
+        return self.executescript(CREATE_TWO_VIEW_GEOMETRIES_TABLE)
+
+    def create_keypoints_table(self):
+        return self.executescript(CREATE_KEYPOINTS_TABLE)
+
+    def create_matches_table(self):
+        return self.executescript(CREATE_MATCHES_TABLE)
+
+    def create_name_index(self):
+        return self.executescript(CREATE_NAME_INDEX)
 
     def _get_image_prior_columns(self):
         if self._image_prior_columns is None:
@@ -153,110 +226,151 @@ class COLMAPDatabase(sqlite3.Connection):
                 )
         return self._image_prior_columns
 
+    def _get_update_image_sql(self):
+        if self._update_image_sql is None:
+            self._update_image_sql = \
+                _UPDATE_IMAGE_SQL[self._get_image_prior_columns()]
+        return self._update_image_sql
+
     def update_camera(self, model, width, height, params, camera_id):
-        params = np.asarray(params, np.float64)
+        params = np.ascontiguousarray(params, np.float64)
         cursor = self.execute(
             "UPDATE cameras SET model=?, width=?, height=?, params=?, prior_focal_length=True WHERE camera_id=?",
             (model, width, height, array_to_blob(params), camera_id))
         return cursor.lastrowid
 
     def update_image(self, IMAGE_ID, QW, QX, QY, QZ, TX, TY, TZ, CAMERA_ID):
-        prior_q_columns, prior_t_columns = self._get_image_prior_columns()
-        column_updates = [f"{col}=?" for col in prior_q_columns + prior_t_columns]
-        column_updates.append("camera_id=?")
-        sql = f"UPDATE images SET {', '.join(column_updates)} WHERE image_id=?"
-        values = (QW, QX, QY, QZ, TX, TY, TZ, CAMERA_ID, IMAGE_ID)
-        cursor = self.execute(sql, values)
+        # After the first call this is one attribute read and one execute().
+        sql = self._update_image_sql or self._get_update_image_sql()
+        cursor = self.execute(
+            sql, (QW, QX, QY, QZ, TX, TY, TZ, CAMERA_ID, IMAGE_ID))
         return cursor.lastrowid
 
-def camTodatabase(txtfile, dbfile):
-
-    camModelDict = {'SIMPLE_PINHOLE': 0,
-                    'PINHOLE': 1,
-                    'SIMPLE_RADIAL': 2,
-                    'RADIAL': 3,
-                    'OPENCV': 4,
-                    'FULL_OPENCV': 5,
-                    'SIMPLE_RADIAL_FISHEYE': 6,
-                    'RADIAL_FISHEYE': 7,
-                    'OPENCV_FISHEYE': 8,
-                    'FOV': 9,
-                    'THIN_PRISM_FISHEYE': 10}
-    # Open the database.
-    db = COLMAPDatabase.connect(dbfile)
+_CAM_MODEL_DICT = {'SIMPLE_PINHOLE': 0,
+                   'PINHOLE': 1,
+                   'SIMPLE_RADIAL': 2,
+                   'RADIAL': 3,
+                   'OPENCV': 4,
+                   'FULL_OPENCV': 5,
+                   'SIMPLE_RADIAL_FISHEYE': 6,
+                   'RADIAL_FISHEYE': 7,
+                   'OPENCV_FISHEYE': 8,
+                   'FOV': 9,
+                   'THIN_PRISM_FISHEYE': 10}
 
-    idList=list()
-    modelList=list()
-    widthList=list()
-    heightList=list()
-    paramsList=list()
+def camTodatabase(txtfile, dbfile, verify=False):
     # Update real cameras from .txt
     with open(txtfile, "r") as cam:
-        lines = cam.readlines()
-        for i in range(0,len(lines),1):
-            if lines[i][0]!='#':
-                strLists = lines[i].split()
-                cameraId=int(strLists[0])
-                cameraModel=camModelDict[strLists[1]] # SelectCameraModel
-                width=int(strLists[2])
-                height=int(strLists[3])
-                paramstr=np.array(strLists[4:12])
-                params = paramstr.astype(np.float64)
-                idList.append(cameraId)
-                modelList.append(cameraModel)
-                widthList.append(width)
-                heightList.append(height)
-                paramsList.append(params)
-                camera_id = db.update_camera(cameraModel, width, height, params, cameraId)
-
-    # Commit the data to the file.
-    db.commit()
-    # Read and check cameras.
-    rows = db.execute("SELECT * FROM cameras")
-    for i in range(0, len(idList),1):
-        camera_id, model, width, height, params, prior = next(rows)
-        params = blob_to_array(params, np.float64)
-        assert camera_id == idList[i]
-        assert model == modelList[i] and width == widthList[i] and height == heightList[i]
-        assert np.allclose(params, paramsList[i])
-
-    # Close database.db.
-    db.close()
+        strLists = [line.split() for line in cam
+                    if line[0] != '#' and line.strip()]
+    # A header-only file has no cameras to update.
+    if len(strLists) == 0:
+        return
+    # CAMERA_ID, MODEL, WIDTH, HEIGHT form a rectangular table parsed column by
+    # column; the number of params depends on the model, so each camera's
+    # params are converted on their own.
+    tokens = np.array([strList[:4] for strList in strLists])
+    idList = tokens[:, 0].astype(np.int32)
+    try:
+        modelList = np.fromiter((_CAM_MODEL_DICT[m] for m in tokens[:, 1]),
+                                dtype=np.int32, count=len(tokens)) # SelectCameraModel
+    except KeyError as e:
+        raise ValueError(
+            f"Unknown camera model '{e.args[0]}' in {txtfile}") from None
+    widthList, heightList = tokens[:, 2:4].astype(np.int32).T
+    paramsList = [np.asarray(strList[4:12], np.float64) for strList in strLists]
+    rows_cam = [
+        (cameraModel, width, height, array_to_blob(params), cameraId)
+        for cameraModel, width, height, params, cameraId in zip(
+            modelList.tolist(), widthList.tolist(), heightList.tolist(),
+            paramsList, idList.tolist())
+    ]
 
-def imgTodatabase(txtfile, dbfile):
     # Open the database.
     db = COLMAPDatabase.connect(dbfile)
+    try:
+        # Write all cameras in a single transaction and commit the data to the file.
+        db.execute("BEGIN")
+        db.executemany(
+            "UPDATE cameras SET model=?, width=?, height=?, params=?, prior_focal_length=1 WHERE camera_id=?",
+            rows_cam)
+        db.commit()
+        if verify:
+            # Read back the updated cameras and check them in one pass.
+            rows = db.execute(
+                "SELECT camera_id, model, width, height, params FROM cameras ORDER BY camera_id"
+            ).fetchall()
+            written = set(idList.tolist())
+            rows = [row for row in rows if row[0] in written]
+            order = np.argsort(idList)
+            assert [row[0] for row in rows] == idList[order].tolist()
+            assert np.array_equal(
+                np.array([row[1:4] for row in rows], np.int32).reshape(-1, 3),
+                np.stack([modelList, widthList, heightList], axis=1)[order])
+            for row, i in zip(rows, order):
+                params = blob_to_array(row[4], np.float64)
+                assert params.shape == paramsList[i].shape
+                assert np.allclose(params, paramsList[i])
+    finally:
+        # Close database.db, restoring its journal mode even on failure.
+        db.close()
+
+def imgTodatabase(txtfile, dbfile):
+    # IMAGE_ID, QW, QX, QY, QZ, TX, TY, TZ, CAMERA_ID, NAME
     with open(txtfile, "r") as images:
-        lines = images.readlines()
-        for i in range(0, len(lines)):
-            image_metas = lines[
-                i
-            ].split()  # IMAGE_ID, QW, QX, QY, QZ, TX, TY, TZ, CAMERA_ID, NAME
-            if len(image_metas) > 0:
-                db.update_image(
-                    IMAGE_ID=int(image_metas[0]),
-                    QW=float(image_metas[1]),
-                    QX=float(image_metas[2]),
-                    QY=float(image_metas[3]),
-                    QZ=float(image_metas[4]),
-                    TX=float(image_metas[5]),
-                    TY=float(image_metas[6]),
-                    TZ=float(image_metas[7]),
-                    CAMERA_ID=int(image_metas[8]),
-                )
-    # Commit the data to the file.
-    db.commit()
-    # Close database.db.
-    db.close()
-    
+        tokens = np.array([line.split()[:9] for line in images
+                           if line.strip() and not line.startswith('#')])
+    # An empty or header-only file has no images to update.
+    if len(tokens) == 0:
+        return
+    ids = tokens[:, 0].astype(np.int64)
+    q = tokens[:, 1:5].astype(np.float64)
+    t = tokens[:, 5:8].astype(np.float64)
+    cams = tokens[:, 8].astype(np.int64)
+    rows_img = [
+        (*q_row, *t_row, cam, image_id)
+        for q_row, t_row, cam, image_id in zip(
+            q.tolist(), t.tolist(), cams.tolist(), ids.tolist())
+    ]
+    # Open the database.
+    db = COLMAPDatabase.connect(dbfile)
+    try:
+        # Write all images in a single transaction and commit the data to the file.
+        db.execute("BEGIN")
+        db.executemany(db._get_update_image_sql(), rows_img)
+        db.commit()
+    finally:
+        # Close database.db, restoring its journal mode even on failure.
+        db.close()
+
+def sceneTodatabase(input_path, verify=False):
+    camTodatabase(txtfile=f"{input_path}/colmap/sparse/origin/cameras.txt",
+                  dbfile=f"{input_path}/colmap/database.db",
+                  verify=verify)
+
+    imgTodatabase(txtfile=f"{input_path}/colmap/sparse/origin/images.txt",
+                  dbfile=f"{input_path}/colmap/database.db")
+
+def scenesTodatabase(input_paths, num_workers=4, verify=False):
+    # Every scene has its own database.db, so the scenes never contend for a
+    # write lock and can be injected in parallel. Each worker opens its own
+    # WAL connection, and sqlite3's default timeout of 5 s is the busy
+    # timeout if COLMAP still holds a database.
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(sceneTodatabase, input_path, verify)
+                   for input_path in input_paths]
+        for future in futures:
+            future.result()
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument("--input_path", "-i", default="")
+    parser.add_argument("--input_path", "-i", nargs="+", default=[""])
+    parser.add_argument("--num_workers", type=int, default=4,
+                        help="number of scenes injected in parallel")
+    parser.add_argument("--verify", action="store_true",
+                        help="read the cameras back and check them after injection")
     args = parser.parse_args()
 
-    camTodatabase(txtfile=f"{args.input_path}/colmap/sparse/origin/cameras.txt", 
-                  dbfile=f"{args.input_path}/colmap/database.db")
-
-    imgTodatabase(txtfile=f"{args.input_path}/colmap/sparse/origin/images.txt",
-                  dbfile=f"{args.input_path}/colmap/database.db")
+    scenesTodatabase(args.input_path, num_workers=args.num_workers,
+                     verify=args.verify)